@@ -5,12 +5,58 @@
 """
 
 import curses
-import curses.textpad
+import curses.ascii
 import docker
-import subprocess
+import requests
+import threading
+import time
+from collections import Counter
+from itertools import islice
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, wait
 
 HEALTHY_STATUS = 'healthy'
 STARTING_STATUS = 'starting'
+UNKNOWN_STATUS = '?'
+# full resync period; container events keep the list current in between
+POLL_INTERVAL = 30.0
+EVENTS_RETRY = 2.0
+# first re-inspect of a container drawn as unknown, doubled up to POLL_INTERVAL
+UNKNOWN_RETRY = 2.0
+MAX_WORKERS = 16
+API_TIMEOUT = 2
+# how long a refresh waits on the inspects before drawing the laggards as unknown
+INSPECT_DEADLINE = 1.0
+DOCKER_ERRORS = (docker.errors.APIError, requests.exceptions.RequestException)
+
+_state = itemgetter('State')
+
+
+def created_key(container):
+    """Sort key on the RFC 3339 'Created' stamp, whose nanoseconds lose their trailing zeros"""
+    stamp = container.attrs.get('Created', '').rstrip('Z')
+    seconds, _, fraction = stamp.partition('.')
+    return seconds, fraction.ljust(9, '0'), container.id
+
+
+def unknown_attrs(container_id, name, created):
+    """Stand-in inspect for a container dockerd failed to describe in time"""
+    return {'Id': container_id, 'Name': name, 'Created': created, 'State': {'Status': UNKNOWN_STATUS}}
+
+
+def health_category(state):
+    """Classify a container State dict as 'down', 'starting', 'up', 'nohealth' or 'unknown'"""
+    if state.get('Status') == UNKNOWN_STATUS:
+        return 'unknown'
+    if 'Health' not in state:
+        return 'nohealth'
+    healthcheck = state['Health']['Status']
+    if healthcheck == HEALTHY_STATUS:
+        return 'up'
+    if healthcheck == STARTING_STATUS:
+        return 'starting'
+    return 'down'
+
 
 class Screen(object):
     UP = -1
@@ -18,6 +64,22 @@ class Screen(object):
     LEFT = -3
     RIGHT = 3
 
+    HEADER_TITLE = "{:^20s} ".format("Docker Administration")
+    HEADER_RULE = "{:^20s} ".format("---------------------")
+    FOOTER_UP = "{} UP "
+    FOOTER_RESTART = "{} RESTART "
+    FOOTER_DOWN = "{} DOWN |  "
+    FOOTER_ACTION = "LAST ACTION: RESTART {} ON CONTAINER {} "
+
+    # (state category, selected) -> color pair
+    COLOR = {
+        ('down', False): 1, ('down', True): 7,
+        ('starting', False): 3, ('starting', True): 7,
+        ('up', False): 2, ('up', True): 7,
+        ('nohealth', False): 6, ('nohealth', True): 7,
+        ('unknown', False): 4, ('unknown', True): 7,
+    }
+
     def __init__(self, size_column, height_column):
         self.window = None
 
@@ -25,6 +87,8 @@ class Screen(object):
         self.height = 0
         self.size_column = size_column
         self.height_column = height_column
+        self._fmt = " {{:{}s}} ".format(size_column)
+        self._last_digest = None
 
         self.init_curses()
 
@@ -35,8 +99,38 @@ class Screen(object):
         self.bottom = 0
         self.current = 0
         self.page = self.bottom // self.max_lines
+        # number of cells display() has room for, the cursor stays within them
+        self._visible = 0
         self.action = ""
-        self.client = docker.from_env()
+        # INITIATED until the restart call returns, then DONE or FAILED
+        self.action_state = ""
+        # one client shared by the UI, the poller and the pool workers, with a
+        # connection pool large enough for every worker to keep its socket
+        self.client = docker.from_env(timeout=API_TIMEOUT, max_pool_size=MAX_WORKERS)
+        self.api = self.client.api
+
+        self._lock = threading.Lock()
+        # (containers, names, categories), replaced as a whole and never mutated
+        self._snapshot = ([], (), ())
+        self._names = ()
+        self._categories = ()
+        # bumped by every event update, so a relist can tell which of its
+        # containers changed while it was in flight
+        self._generation = 0
+        self._event_gen = {}
+        # bumped by every relist, so a late inspect can tell it is outdated
+        self._relists = 0
+        # ids of the unknown containers with a re-inspect scheduled
+        self._retrying = set()
+        self._interval = POLL_INTERVAL
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        self._events = None
+        # ids of the containers with a restart still running
+        self._inflight = set()
+        threading.Thread(target=self._poller, daemon=True).start()
+        threading.Thread(target=self._watch_events, daemon=True).start()
 
     def init_curses(self):
         """Setup the curses"""
@@ -73,7 +167,9 @@ class Screen(object):
                         curses.COLOR_YELLOW,
                         curses.COLOR_BLACK)
 
-        self.current = curses.color_pair(2)
+        # resolve the bold attributes once rather than on every addstr
+        self._attrs = {n: curses.color_pair(n) | curses.A_BOLD for n in range(1, 9)}
+        self._row_attrs = {key: self._attrs[n] for key, n in self.COLOR.items()}
 
         self.height, self.width = self.window.getmaxyx()
 
@@ -84,15 +180,22 @@ class Screen(object):
         except KeyboardInterrupt:
             pass
         finally:
+            self._stop.set()
+            self._wake.set()
+            if self._events is not None:
+                self._events.close()
+            self._pool.shutdown(wait=False)
             curses.endwin()
 
     def input_stream(self):
         """Waiting an input and run a proper method according to type of input"""
 
         while True:
-            self.containers = self.client.containers.list()
-            self.bottom = len(self.containers)
-            self.page = self.bottom // self.max_lines
+            with self._lock:
+                self.containers, self._names, self._categories = self._snapshot
+            if len(self.containers) != self.bottom:
+                self.bottom = len(self.containers)
+                self.page = self.bottom // self.max_lines
             self.display()
 
             ch = self.window.getch()
@@ -109,12 +212,199 @@ class Screen(object):
             elif ch == curses.ascii.ESC:
                 break
 
+    def _poller(self):
+        """Fetch the containers in the background so the UI never waits on dockerd"""
+        while not self._stop.is_set():
+            self._wake.clear()
+            with self._lock:
+                start = self._generation
+            try:
+                containers, late = self._list_containers()
+            except DOCKER_ERRORS:
+                # keep showing the last known state until dockerd answers again
+                pass
+            except RuntimeError:
+                # run() shut the pool down while we were listing
+                if self._stop.is_set():
+                    break
+                raise
+            else:
+                self._publish_relist(containers, late, start)
+            self._wake.wait(self._interval)
+
+    def _publish_relist(self, containers, late, start):
+        """Publish a relist, then fill in its late inspects as they come back"""
+        with self._lock:
+            # until its late inspect resolves, a container we already know
+            # keeps its previous state rather than turning unknown
+            previous = {c.id: c for c in self._snapshot[0] if c.id in late}
+            containers = [previous.get(c.id, c) for c in containers]
+            self._publish(self._merge_events(containers, start))
+            self._event_gen.clear()
+            self._relists += 1
+            relist = self._relists
+        for container_id, future in late.items():
+            future.add_done_callback(
+                lambda f, cid=container_id: self._late_inspect(cid, f, relist))
+
+    def _late_inspect(self, container_id, future, relist):
+        """Apply an inspect that missed INSPECT_DEADLINE, unless something newer already did"""
+        with self._lock:
+            if relist != self._relists or container_id in self._event_gen:
+                return
+            if future.exception() is None:
+                self._apply(container_id, future.result())
+                return
+            # the previous state carried over by the relist is no longer trusted
+            snapshot = []
+            for c in self._snapshot[0]:
+                if c.id == container_id:
+                    c = self.client.containers.prepare_model(
+                        unknown_attrs(c.id, c.attrs['Name'], c.attrs['Created']))
+                snapshot.append(c)
+            self._publish(snapshot)
+
+    def _watch_events(self):
+        """Re-inspect a single container whenever dockerd reports a change on it"""
+        while not self._stop.is_set():
+            try:
+                self._events = self.client.events(decode=True, filters={'type': 'container'})
+                for event in self._events:
+                    if event.get('Action', '').startswith('exec_'):
+                        continue
+                    self._update_container(event['Actor']['ID'])
+            except DOCKER_ERRORS:
+                # dockerd refused or dropped the connection; socket errors on the
+                # open stream, including run() closing it on exit, just end it
+                pass
+            if self._stop.wait(EVENTS_RETRY):
+                break
+            # events may have been missed while disconnected
+            self._refresh()
+
+    def _update_container(self, container_id):
+        """Replace, add or drop one container in the snapshot"""
+        try:
+            attrs = self._inspect(container_id)
+        except DOCKER_ERRORS:
+            # left as is, the next full refresh will catch up
+            return
+        with self._lock:
+            self._generation += 1
+            self._event_gen[container_id] = self._generation
+            self._apply(container_id, attrs)
+
+    def _apply(self, container_id, attrs):
+        """Replace, add or drop one container in the snapshot given its inspect, lock held"""
+        container = None
+        # a container between the die and start of a restart keeps its row
+        if attrs is not None and (attrs['State']['Running'] or attrs['State']['Restarting']
+                                  or container_id in self._inflight):
+            container = self.client.containers.prepare_model(attrs)
+        snapshot = [c for c in self._snapshot[0] if c.id != container_id]
+        if container is not None:
+            snapshot.append(container)
+        self._publish(snapshot)
+
+    def _schedule_retry(self, container_id, delay):
+        timer = threading.Timer(delay, self._retry_unknown, (container_id, delay))
+        timer.daemon = True
+        timer.start()
+
+    def _retry_unknown(self, container_id, delay):
+        """Re-inspect one unknown container, backing off while dockerd still fails on it"""
+        if self._stop.is_set():
+            return
+        self._update_container(container_id)
+        with self._lock:
+            containers, _, categories = self._snapshot
+            if any(c.id == container_id and cat == 'unknown' for c, cat in zip(containers, categories)):
+                self._schedule_retry(container_id, min(delay * 2, POLL_INTERVAL))
+            else:
+                self._retrying.discard(container_id)
+
+    def _merge_events(self, containers, start):
+        """Keep the snapshot's state for containers updated by events since generation start, lock held"""
+        fresh = {cid for cid, gen in self._event_gen.items() if gen > start}
+        if not fresh:
+            return containers
+        merged = [c for c in containers if c.id not in fresh]
+        merged.extend(c for c in self._snapshot[0] if c.id in fresh)
+        return merged
+
+    def _publish(self, containers):
+        """Extract what display() needs once per update rather than once per frame, lock held"""
+        # newest first like `docker ps`, so a container stopped and started
+        # again by a restart comes back to the same row under the cursor
+        containers = sorted(containers, key=created_key, reverse=True)
+        names = tuple(c.name for c in containers)
+        categories = tuple(health_category(_state(c.attrs)) for c in containers)
+        self._snapshot = (containers, names, categories)
+        # unknown containers are re-inspected on their own rather than by
+        # relisting the whole fleet
+        for c, cat in zip(containers, categories):
+            if cat == 'unknown' and c.id not in self._retrying:
+                self._retrying.add(c.id)
+                self._schedule_retry(c.id, UNKNOWN_RETRY)
+
+    def _list_containers(self):
+        """List the running containers, inspecting them concurrently
+
+        Returns the containers and, by id, the inspect futures that missed
+        INSPECT_DEADLINE; those containers are listed with an unknown state.
+        """
+        summaries = self.client.containers.list(sparse=True)
+        futures = [self._pool.submit(self._inspect, c.id) for c in summaries]
+        wait(futures, timeout=INSPECT_DEADLINE)
+        containers = []
+        late = {}
+        for summary, future in zip(summaries, futures):
+            if not future.done():
+                late[summary.id] = future
+            if future.done() and future.exception() is None:
+                attrs = future.result()
+                if attrs is None:
+                    continue
+            else:
+                # too slow or failed: still listed, with an unknown state
+                attrs = unknown_attrs(
+                    summary.id, summary.attrs['Names'][0],
+                    time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(summary.attrs['Created'])))
+            containers.append(self.client.containers.prepare_model(attrs))
+        return containers, late
+
+    def _inspect(self, container_id):
+        """Inspect a container, None if it no longer exists"""
+        try:
+            return self.api.inspect_container(container_id)
+        except docker.errors.NotFound:
+            # removed between the listing and the inspect
+            return None
+
+    def _refresh(self):
+        """Wake the poller up for an immediate refetch"""
+        self._wake.set()
+
     def doAction(self):
-        for idx, container in enumerate(self.containers):
-            if idx == self.current:
-                self.action = container.name
-                subprocess.Popen(["docker","restart",container.name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return
+        if 0 <= self.current < len(self.containers):
+            container = self.containers[self.current]
+            self.action = container.name
+            self.action_state = 'INITIATED'
+            if container.id in self._inflight:
+                return
+            self._inflight.add(container.id)
+            future = self._pool.submit(self.api.restart, container.id)
+            future.add_done_callback(
+                lambda f, cid=container.id, name=container.name: self._restart_done(cid, name, f))
+
+    def _restart_done(self, container_id, name, future):
+        """Acknowledge a finished restart and settle the container's row"""
+        self._inflight.discard(container_id)
+        if self.action == name:
+            self.action_state = 'FAILED' if future.exception() is not None else 'DONE'
+        # the row was kept while the restart ran; if the container died again
+        # meanwhile no further event will come to drop it
+        self._update_container(container_id)
 
     def scroll(self, direction):
         """Scrolling the window when pressing up/down arrow keys"""
@@ -133,11 +423,11 @@ class Screen(object):
             self.top += direction
             return
 
-        if (direction == self.DOWN) and (next_line < self.max_lines) and (self.top + next_line < self.bottom):
+        if (direction == self.DOWN) and (next_line < self.max_lines) and (self.top + next_line < min(self.bottom, self._visible)):
             self.current = next_line
             return
 
-        if (direction == self.RIGHT) and (next_line < self.max_lines) and (self.top + next_line < self.bottom):
+        if (direction == self.RIGHT) and (next_line < self.max_lines) and (self.top + next_line < min(self.bottom, self._visible)):
             self.current = next_line
             return
 
@@ -168,53 +458,46 @@ class Screen(object):
 
     def display(self):
         """Display the items on window"""
-        self.window.erase()
         height, width = self.window.getmaxyx()
+        # only the cells whose column starts inside the window are drawn; a
+        # resize or a shorter list pulls the cursor back onto a drawn cell
+        self._visible = ((width - 1) // self.size_column + 1) * max(0, self.height_column - 3)
+        self.current = max(0, min(self.current, min(self.bottom, self._visible) - 1))
+        # nothing to redraw if neither the containers nor the cursor changed
+        digest = hash((self._names, self._categories, self.current, self.action, self.action_state, height, width))
+        if digest == self._last_digest:
+            return
+        self._last_digest = digest
+
+        self.window.erase()
         i = 3
         j = 0
-        total_containers = 0
-        down, restart, up = 0, 0 ,0
-        self.window.addstr(0, 0, "{:^20s} ".format("Docker Administration"), curses.color_pair(4) | curses.A_BOLD)
-        self.window.addstr(1, 0, "{:^20s} ".format("---------------------"), curses.color_pair(4) | curses.A_BOLD)
+        # counted in C over every container, but only the visible cells are drawn
+        counts = Counter(self._categories)
+        addnstr = self.window.addnstr
+        addnstr(0, 0, self.HEADER_TITLE, width, self._attrs[4])
+        addnstr(1, 0, self.HEADER_RULE, width, self._attrs[4])
    
-        for idx, container in enumerate(self.containers):
-            state = self.client.api.inspect_container(container.id)
-            if 'Health' in state['State']:
-                healthcheck = state['State']['Health']['Status']
-                if healthcheck != HEALTHY_STATUS and healthcheck != STARTING_STATUS:
-                    if idx == self.current:
-                        self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(7) | curses.A_BOLD)
-                    else:
-                        self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(1) | curses.A_BOLD)
-                    down = down + 1
-                elif healthcheck == STARTING_STATUS:
-                    if idx == self.current:
-                        self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(7) | curses.A_BOLD)
-                    else:
-                        self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(3) | curses.A_BOLD)
-                    restart = restart + 1
-                else:
-                    if idx == self.current:
-                        self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(7) | curses.A_BOLD)
-                    else:
-                        self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(2) | curses.A_BOLD)
-                    up = up + 1
-            else:
-                if idx == self.current:
-                    self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(7) | curses.A_BOLD)
-                else:
-                    self.window.addstr(i, j, " {0:{1}s} ".format(container.name, self.size_column), curses.color_pair(6) | curses.A_BOLD)                
+        # rows are written column by column, top to bottom
+        for idx, (name, cat) in enumerate(islice(zip(self._names, self._categories), self._visible)):
+            # clipped at the right edge rather than wrapping onto the next line
+            addnstr(i, j, self._fmt.format(name), width - j, self._row_attrs[(cat, idx == self.current)])
             i = i + 1
             if i == self.height_column:
                 j = j + self.size_column
                 i = 3
         
-        self.window.addstr(height-1, 0, "{} ".format(str(up) + " UP"), curses.color_pair(6) | curses.A_BOLD)
-        self.window.addstr(height-1, 6, "{} ".format(str(restart) + " RESTART"), curses.color_pair(8) | curses.A_BOLD)
-        self.window.addstr(height-1, 17, "{} ".format(str(down) + " DOWN | "), curses.color_pair(5) | curses.A_BOLD)
-        if self.action and restart != 0:
-            self.window.addstr(height-1, 26, "{} ".format("LAST ACTION: RESTART INITIATED ON CONTAINER " + self.action), curses.color_pair(4) | curses.A_BOLD)
-        self.window.refresh()
+        up, restart, down = counts['up'], counts['starting'], counts['down']
+        # the bottom-right cell is left alone: curses errors when writing it
+        # moves the cursor past the end of the window
+        last = width - 1
+        addnstr(height-1, 0, self.FOOTER_UP.format(up), last, self._attrs[6])
+        addnstr(height-1, 6, self.FOOTER_RESTART.format(restart), last - 6, self._attrs[8])
+        addnstr(height-1, 17, self.FOOTER_DOWN.format(down), last - 17, self._attrs[5])
+        if self.action and (restart != 0 or self.action_state == 'FAILED'):
+            addnstr(height-1, 26, self.FOOTER_ACTION.format(self.action_state, self.action), last - 26, self._attrs[4])
+        self.window.noutrefresh()
+        curses.doupdate()
 
 
 def main():